@@ -1,7 +1,14 @@
 # This script generates the research page from the research.yml file.
 
+import re
+
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 header = """
 <!-- This is automatically generated from research.yml. Do not edit this file directly. -->
 # Research
@@ -11,16 +18,10 @@ Following is a list of research papers that have been published using the PDEAre
 If you have used PDEArena in your research, and would like it listed here, please add your paper to [this file](https://github.com/microsoft/pdearena/blob/main/docs/research.yml) by sending a pull request to the [PDEArena repository](https://github.com/microsoft/pdearena).
 """
 
+# Affiliation markers such as "(1,2)" after author names
+affiliation_re = re.compile(r"\(([^)]+)\)")
 
-def snippet(paper):
-    title = paper["title"]
-    authors = ", ".join(paper["authors"]).replace("(", "<sup>").replace(")", "</sup>")
-    affiliations = ", ".join(f"<sup>{num}</sup>{affil}" for num, affil in paper["affiliations"].items())
-    link = paper["link"]
-    abstract = paper["abstract"]
-    image_file = paper["image"]
-
-    paper_snippet = f"""
+snippet_template = """
 
 <figure markdown>
 ![](assets/images/research/{image_file}){{ width="500"}}
@@ -39,21 +40,34 @@ def snippet(paper):
 **Abstract:** {abstract}\n\n
 
     """
-    return paper_snippet
+
+
+def snippet(paper):
+    authors = affiliation_re.sub(r"<sup>\1</sup>", ", ".join(paper["authors"]))
+    affiliations = ", ".join(f"<sup>{num}</sup>{affil}" for num, affil in paper["affiliations"].items())
+    return snippet_template.format(
+        image_file=paper["image"],
+        link=paper["link"],
+        title=paper["title"],
+        authors=authors,
+        affiliations=affiliations,
+        abstract=paper["abstract"],
+    )
 
 
 def main(outfile):
     with open("research.yml") as f:
-        research = yaml.load(f, Loader=yaml.SafeLoader)["papers"]
+        research = yaml.load(f, Loader=SafeLoader)["papers"]
 
     with open(outfile, "w") as f:
         f.write(header)
 
         research = sorted(research, key=lambda x: x["date"], reverse=True)
 
-        snippets = [snippet(paper) for paper in research]
-
-        f.write("\n\n---\n\n".join(snippets))
+        for i, paper in enumerate(research):
+            if i > 0:
+                f.write("\n\n---\n\n")
+            f.write(snippet(paper))
 
 
 if __name__ == "__main__":
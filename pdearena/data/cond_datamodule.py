@@ -1,6 +1,6 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
-from typing import List
+from typing import List, Optional
 
 import torch
 import torch.utils.data.datapipes.datapipe as dp
@@ -52,6 +52,8 @@ class CondPDEDataModule(LightningDataModule):
         test_limit_trajectories (int): Number of trajectories to use for testing.
         eval_dts (List[int], optional): List of timesteps to use for evaluation. Defaults to [1, 2, 4, 8, 16].
         usegrid (bool, optional): Whether to use the grid. Defaults to False.
+        persistent_workers (bool, optional): Whether to keep the worker processes alive between epochs. Only used when `num_workers > 0`. Defaults to False.
+        prefetch_factor (Optional[int], optional): Number of batches loaded in advance by each worker. Only used when `num_workers > 0`. Defaults to None, i.e. PyTorch's default.
     """
 
     def __init__(
@@ -67,6 +69,8 @@ class CondPDEDataModule(LightningDataModule):
         test_limit_trajectories: int,
         eval_dts: List[int] = [1, 2, 4, 8, 16],
         usegrid: bool = False,
+        persistent_workers: bool = False,
+        prefetch_factor: Optional[int] = None,
     ):
         super().__init__()
         self.data_dir = data_dir
@@ -97,6 +101,15 @@ class CondPDEDataModule(LightningDataModule):
         # else:
         #     raise NotImplementedError()
 
+    def _worker_kwargs(self):
+        # These options are only valid for multi-process data loading
+        if self.hparams.num_workers == 0:
+            return {}
+        kwargs = {"persistent_workers": self.hparams.persistent_workers}
+        if self.hparams.prefetch_factor is not None:
+            kwargs["prefetch_factor"] = self.hparams.prefetch_factor
+        return kwargs
+
     def setup(self, stage=None):
         dps = DATAPIPE_REGISTRY[self.hparams.task]
         self.train_dp = dps["train"](
@@ -150,6 +163,7 @@ class CondPDEDataModule(LightningDataModule):
             dataset=self.train_dp,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            **self._worker_kwargs(),
             batch_size=self.hparams.batch_size,
             shuffle=True,
             drop_last=True,
@@ -162,6 +176,7 @@ class CondPDEDataModule(LightningDataModule):
                 dataset=dp,
                 num_workers=self.hparams.num_workers,
                 pin_memory=self.hparams.pin_memory,
+                **self._worker_kwargs(),
                 batch_size=self.hparams.batch_size,
                 shuffle=False,
                 collate_fn=collate_fn_cat,
@@ -175,6 +190,7 @@ class CondPDEDataModule(LightningDataModule):
             dataset=self.test_dp,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            **self._worker_kwargs(),
             batch_size=self.hparams.batch_size,
             shuffle=False,
             collate_fn=collate_fn_stack,
@@ -184,6 +200,7 @@ class CondPDEDataModule(LightningDataModule):
                 dataset=dp,
                 num_workers=self.hparams.num_workers,
                 pin_memory=self.hparams.pin_memory,
+                **self._worker_kwargs(),
                 batch_size=self.hparams.batch_size,
                 shuffle=False,
                 collate_fn=collate_fn_cat,
@@ -6,9 +6,13 @@ import torch
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader
 
+from pdearena import utils
+
 from .registry import DATAPIPE_REGISTRY
 from .utils import PDEDataConfig
 
+logger = utils.get_logger(__name__)
+
 
 def collate_fn_cat(batch):
     # Assuming pairs
@@ -60,6 +64,12 @@ class PDEDataModule(LightningDataModule):
         valid_limit_trajectories (int): The number of trajectories to be used for validation. This is from each shard.
         test_limit_trajectories (int): The number of trajectories to be used for testing. This is from each shard.
         usegrid (bool, optional): Whether to use a grid. Defaults to False.
+        persistent_workers (bool, optional): Whether to keep the worker processes alive between epochs. Only used when `num_workers > 0`. Defaults to False.
+        prefetch_factor (Optional[int], optional): Number of batches loaded in advance by each worker. Only used when `num_workers > 0`. Defaults to None, i.e. PyTorch's default.
+        prefetch_buffer_size (int, optional): Number of trajectories loaded ahead in a background thread by each datapipe. `0` disables prefetching. Defaults to 8.
+        cache_in_memory (bool, optional): Whether to keep loaded trajectories in memory. The cache is unbounded. It only avoids re-reading trajectories across epochs with `num_workers=0` or `persistent_workers=True`, since new workers start with an empty cache. Defaults to False.
+        samples_per_trajectory (Optional[int], optional): Number of random training samples drawn from each loaded trajectory. Defaults to None, i.e. the trajectory length.
+        shuffle_buffer_size (Optional[int], optional): Size of the buffer that mixes training samples of different trajectories. Defaults to None, i.e. the samples of 8 trajectories.
     """
 
     def __init__(
@@ -77,12 +87,32 @@ class PDEDataModule(LightningDataModule):
         valid_limit_trajectories: int,
         test_limit_trajectories: int,
         usegrid: bool = False,
+        persistent_workers: bool = False,
+        prefetch_factor: Optional[int] = None,
+        prefetch_buffer_size: int = 8,
+        cache_in_memory: bool = False,
+        samples_per_trajectory: Optional[int] = None,
+        shuffle_buffer_size: Optional[int] = None,
     ):
         super().__init__()
         self.data_dir = data_dir
         self.pde = pde
 
         self.save_hyperparameters(ignore="pde", logger=False)
+        if cache_in_memory and num_workers > 0 and not persistent_workers:
+            logger.warning(
+                "cache_in_memory has no effect across epochs without persistent_workers: "
+                "every epoch starts new workers with an empty cache."
+            )
+
+    def _worker_kwargs(self):
+        # These options are only valid for multi-process data loading
+        if self.hparams.num_workers == 0:
+            return {}
+        kwargs = {"persistent_workers": self.hparams.persistent_workers}
+        if self.hparams.prefetch_factor is not None:
+            kwargs["prefetch_factor"] = self.hparams.prefetch_factor
+        return kwargs
 
     def setup(self, stage: Optional[str] = None):
         dps = DATAPIPE_REGISTRY[self.hparams.task]
@@ -94,6 +124,10 @@ class PDEDataModule(LightningDataModule):
             time_history=self.hparams.time_history,
             time_future=self.hparams.time_future,
             time_gap=self.hparams.time_gap,
+            prefetch_buffer_size=self.hparams.prefetch_buffer_size,
+            cache_in_memory=self.hparams.cache_in_memory,
+            samples_per_trajectory=self.hparams.samples_per_trajectory,
+            shuffle_buffer_size=self.hparams.shuffle_buffer_size,
         )
         self.valid_dp1 = dps["valid"][0](
             pde=self.pde,
@@ -103,6 +137,8 @@ class PDEDataModule(LightningDataModule):
             time_history=self.hparams.time_history,
             time_future=self.hparams.time_future,
             time_gap=self.hparams.time_gap,
+            prefetch_buffer_size=self.hparams.prefetch_buffer_size,
+            cache_in_memory=self.hparams.cache_in_memory,
         )
         self.valid_dp2 = dps["valid"][1](
             pde=self.pde,
@@ -112,6 +148,8 @@ class PDEDataModule(LightningDataModule):
             time_history=self.hparams.time_history,
             time_future=self.hparams.time_future,
             time_gap=self.hparams.time_gap,
+            prefetch_buffer_size=self.hparams.prefetch_buffer_size,
+            cache_in_memory=self.hparams.cache_in_memory,
         )
         self.test_dp_onestep = dps["test"][0](
             pde=self.pde,
@@ -121,6 +159,8 @@ class PDEDataModule(LightningDataModule):
             time_history=self.hparams.time_history,
             time_future=self.hparams.time_future,
             time_gap=self.hparams.time_gap,
+            prefetch_buffer_size=self.hparams.prefetch_buffer_size,
+            cache_in_memory=self.hparams.cache_in_memory,
         )
         self.test_dp = dps["test"][1](
             pde=self.pde,
@@ -130,6 +170,8 @@ class PDEDataModule(LightningDataModule):
             time_history=self.hparams.time_history,
             time_future=self.hparams.time_future,
             time_gap=self.hparams.time_gap,
+            prefetch_buffer_size=self.hparams.prefetch_buffer_size,
+            cache_in_memory=self.hparams.cache_in_memory,
         )
 
     def train_dataloader(self):
@@ -137,6 +179,7 @@ class PDEDataModule(LightningDataModule):
             dataset=self.train_dp,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            **self._worker_kwargs(),
             batch_size=self.hparams.batch_size,
             shuffle=True,
             drop_last=True,
@@ -148,6 +191,7 @@ class PDEDataModule(LightningDataModule):
             dataset=self.valid_dp1,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            **self._worker_kwargs(),
             batch_size=self.hparams.batch_size,
             shuffle=False,
             collate_fn=collate_fn_cat,
@@ -156,6 +200,7 @@ class PDEDataModule(LightningDataModule):
             dataset=self.valid_dp2,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            **self._worker_kwargs(),
             batch_size=self.hparams.batch_size,  # TODO: might need to reduce this
             shuffle=False,
             collate_fn=collate_fn_stack,
@@ -167,6 +212,7 @@ class PDEDataModule(LightningDataModule):
             dataset=self.test_dp,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            **self._worker_kwargs(),
             batch_size=self.hparams.batch_size,
             shuffle=False,
             collate_fn=collate_fn_stack,
@@ -175,6 +221,7 @@ class PDEDataModule(LightningDataModule):
             dataset=self.test_dp_onestep,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
+            **self._worker_kwargs(),
             batch_size=self.hparams.batch_size,
             shuffle=False,
             collate_fn=collate_fn_cat,
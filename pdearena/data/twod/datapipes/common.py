@@ -2,8 +2,7 @@
 # Licensed under the MIT license.
 
 import os
-import random
-from typing import Callable, Optional, Sequence, Union
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
@@ -13,6 +12,37 @@ import pdearena.data.utils as datautils
 from pdearena.data.utils import PDEDataConfig
 
 
+def _new_rng() -> np.random.Generator:
+    # Seeded from torch's generator, which the DataLoader seeds differently for every worker when it starts it.
+    # Persistent workers are only seeded once, but their generator state carries over, so later epochs still differ.
+    return np.random.default_rng(int(torch.randint(0, 2**62, ()).item()))
+
+
+def _merge_fields(u, v, channels: Tuple[int, int]) -> torch.Tensor:
+    # Lay out the leading scalar and vector channels of a trajectory side by side in a single tensor
+    n_scalar, n_vector = channels
+    fields = []
+    if n_scalar > 0:
+        fields.append(u[:, :n_scalar])
+    if n_vector > 0:
+        fields.append(v[:, :n_vector])
+    if len(fields) == 1:
+        return fields[0]
+    return torch.cat(fields, dim=1)
+
+
+def _unpack_trajectory(batch):
+    # Trajectories come as (u, v, grid) or (u, v, cond, grid)
+    if len(batch) == 3:
+        (u, v, grid) = batch
+        cond = None
+    elif len(batch) == 4:
+        (u, v, cond, grid) = batch
+    else:
+        raise ValueError(f"Unknown batch length of {len(batch)}.")
+    return u, v, cond, grid
+
+
 def build_datapipes(
     pde: PDEDataConfig,
     data_path,
@@ -30,6 +60,10 @@ def build_datapipes(
     conditioned=False,
     delta_t: Optional[int] = None,
     conditioned_reweigh: bool = True,
+    prefetch_buffer_size: int = 8,
+    cache_in_memory: bool = False,
+    samples_per_trajectory: Optional[int] = None,
+    shuffle_buffer_size: Optional[int] = None,
 ):
     """Build datapipes for training and evaluation.
 
@@ -50,6 +84,10 @@ def build_datapipes(
         conditioned (bool, optional): Whether to use conditioned data. Defaults to False.
         delta_t (Optional[int], optional): Time step size. Defaults to None. Only used for conditioned data.
         conditioned_reweigh (bool, optional): Whether to reweight conditioned data. Defaults to True.
+        prefetch_buffer_size (int, optional): Number of trajectories loaded ahead in a background thread. `0` disables prefetching. Defaults to 8.
+        cache_in_memory (bool, optional): Whether to keep loaded trajectories in memory so that repeated passes don't hit the disk. The cache is unbounded, so only enable it when the trajectories of each worker fit in memory. Later passes replay the trajectories in the order of the first pass, which undoes the file-level shuffling for later epochs. When loading with worker processes, the cache only lives as long as the workers, so it only helps across epochs with persistent workers. Defaults to False.
+        samples_per_trajectory (Optional[int], optional): Number of random samples drawn from each loaded trajectory during unconditioned training. Defaults to None, i.e. `pde.trajlen`.
+        shuffle_buffer_size (Optional[int], optional): Size of the buffer that mixes samples of different trajectories during unconditioned training. Defaults to None, i.e. the samples of 8 trajectories.
 
     Returns:
         dpipe (IterDataPipe): IterDataPipe for training and evaluation.
@@ -66,13 +104,18 @@ def build_datapipes(
         limit_trajectories=limit_trajectories,
         usegrid=usegrid,
     )
-    if mode == "train":
-        # Make sure that in expectation we have seen all the data despite randomization
-        dpipe = dpipe.cycle(pde.trajlen)
+    if cache_in_memory:
+        # Caching happens after sharding, so every worker only holds its own trajectories.
+        # The cache lives in the worker, so it is lost whenever the DataLoader starts new workers.
+        dpipe = dpipe.in_memory_cache()
+    if prefetch_buffer_size > 0:
+        dpipe = dpipe.prefetch(buffer_size=prefetch_buffer_size)
 
     if mode == "train":
         # Training data is randomized
         if conditioned:
+            # Make sure that in expectation we have seen all the data despite randomization
+            dpipe = dpipe.cycle(pde.trajlen)
             dpipe = RandomTimeStepConditionedPDETrainData(
                 dpipe,
                 pde.n_scalar_components,
@@ -83,7 +126,9 @@ def build_datapipes(
                 conditioned_reweigh,
             )
         else:
-            dpipe = RandomizedPDETrainData(
+            n_cycles = pde.trajlen if samples_per_trajectory is None else samples_per_trajectory
+            # Make sure that in expectation we have seen all the data despite randomization
+            dpipe = CycledRandomizedPDETrainData(
                 dpipe,
                 pde.n_scalar_components,
                 pde.n_vector_components,
@@ -93,7 +138,10 @@ def build_datapipes(
                 time_history,
                 time_future,
                 time_gap,
+                n_cycles=n_cycles,
             )
+            # Consecutive samples come from the same trajectory, so mix them across several trajectories
+            dpipe = dpipe.shuffle(buffer_size=8 * n_cycles if shuffle_buffer_size is None else shuffle_buffer_size)
     else:
         # Evaluation data is not randomized.
         if conditioned and onestep:
@@ -137,12 +185,15 @@ class ZarrLister(dp.iter.IterDataPipe):
             root = dp.iter.IterableWrapper(root)
 
         self.datapipe: dp.iter.IterDataPipe = root
+        # Directory listings are cached per root so that repeated iterations don't hit the filesystem again
+        self._cache: Dict[str, List[str]] = {}
 
     def __iter__(self):
         for path in self.datapipe:
-            for dirname in os.listdir(path):
-                if dirname.endswith(".zarr"):
-                    yield os.path.join(path, dirname)
+            if path not in self._cache:
+                with os.scandir(path) as entries:
+                    self._cache[path] = sorted(entry.path for entry in entries if entry.name.endswith(".zarr"))
+            yield from self._cache[path]
 
 
 class RandomTimeStepConditionedPDETrainData(dp.iter.IterDataPipe):
@@ -177,17 +228,25 @@ class RandomTimeStepConditionedPDETrainData(dp.iter.IterDataPipe):
 
         self.trajlen = trajlen
         self.reweigh = reweigh
-
+        # Unnormalized CDF of the `1 / (start_time + 1)` weights; its prefix up to `end_time` is the CDF for `end_time`
+        self._cumweights = np.cumsum(1 / np.arange(1, trajlen + 1))
+        # Time step tensors are shared between samples; collation copies them into a new batch tensor anyway
+        self._delta_t_tensors = [torch.tensor([delta_t], dtype=torch.long) for delta_t in range(trajlen)]
+
+    # Samples are never differentiated; skipping autograd bookkeeping makes the slicing and copying cheaper.
+    # The decorator, unlike a `with` block, only enables inference mode while the generator itself is running.
+    @torch.inference_mode()
     def __iter__(self):
         time_resolution = self.trajlen
+        rng = _new_rng()
 
         for (u, v, cond, grid) in self.dp:
+            end_time = int(rng.integers(1, time_resolution))
             if self.reweigh:
-                end_time = random.choices(range(1, time_resolution), k=1)[0]
-                start_time = random.choices(range(0, end_time), weights=1 / np.arange(1, end_time + 1), k=1)[0]
+                cumweights = self._cumweights[:end_time]
+                start_time = int(np.searchsorted(cumweights, rng.random() * cumweights[-1], side="right"))
             else:
-                end_time = torch.randint(low=1, high=time_resolution, size=(1,), dtype=torch.long).item()
-                start_time = torch.randint(low=0, high=end_time.item(), size=(1,), dtype=torch.long).item()
+                start_time = int(rng.integers(0, end_time))
 
             delta_t = end_time - start_time
             yield (
@@ -201,7 +260,7 @@ class RandomTimeStepConditionedPDETrainData(dp.iter.IterDataPipe):
                     grid,
                     start_time,
                     end_time,
-                    torch.tensor([delta_t]),
+                    self._delta_t_tensors[delta_t],
                 ),
                 cond,
             )
@@ -227,25 +286,28 @@ class TimestepConditionedPDEEvalData(dp.iter.IterDataPipe):
             raise ValueError("delta_t should be less than half the trajectory length")
 
         self.delta_t = delta_t
+        self._delta_t_tensor = torch.tensor([delta_t], dtype=torch.long)
 
+    @torch.inference_mode()
     def __iter__(self):
-
-        for begin in range(self.trajlen - self.delta_t):
-            for (u, v, cond, grid) in self.dp:
-                newu = u[begin :: self.delta_t, ...]
-                newv = v[begin :: self.delta_t, ...]
-                max_start_time = newu.size(0)
+        # Each trajectory is read once and all its evaluation windows are emitted before moving on to the next one
+        for (u, v, cond, grid) in self.dp:
+            # Merged once per trajectory so that every window below is a view instead of a new concatenation
+            uv = torch.cat((u, v), dim=1)
+            for begin in range(self.trajlen - self.delta_t):
+                newuv = uv[begin :: self.delta_t, ...]
+                max_start_time = newuv.size(0)
                 for start in range(max_start_time - 1):
                     end = start + 1
-                    data = torch.cat((newu[start : start + 1], newv[start : start + 1]), dim=1).unsqueeze(0)
+                    data = newuv[start : start + 1].unsqueeze(0)
                     if grid is not None:
                         data = torch.cat((data, grid), dim=1)
-                    label = torch.cat((newu[end : end + 1], newv[end : end + 1]), dim=1).unsqueeze(0)
+                    label = newuv[end : end + 1].unsqueeze(0)
                     if data.size(1) == 0:
                         raise ValueError("Data is empty. Likely indexing issue.")
                     if label.size(1) == 0:
                         raise ValueError("Label is empty. Likely indexing issue.")
-                    yield data, label, torch.tensor([self.delta_t]), cond
+                    yield data, label, self._delta_t_tensor, cond
 
 
 class RandomizedPDETrainData(dp.iter.IterDataPipe):
@@ -286,25 +348,20 @@ class RandomizedPDETrainData(dp.iter.IterDataPipe):
         self.time_future = time_future
         self.time_gap = time_gap
 
-    def __iter__(self):
-        # Length of trajectory
-        time_resolution = self.trajlen
         # Max number of previous points solver can eat
-        reduced_time_resolution = time_resolution - self.time_history
+        reduced_time_resolution = trajlen - time_history
         # Number of future points to predict
-        max_start_time = reduced_time_resolution - self.time_future - self.time_gap
+        self._max_start_time = reduced_time_resolution - time_future - time_gap
 
+    @torch.inference_mode()
+    def __iter__(self):
+        max_start_time = self._max_start_time
+        rng = _new_rng()
         for batch in self.dp:
-            if len(batch) == 3:
-                (u, v, grid) = batch
-                cond = None
-            elif len(batch) == 4:
-                (u, v, cond, grid) = batch
-            else:
-                raise ValueError(f"Unknown batch length of {len(batch)}.")
+            u, v, _, grid = _unpack_trajectory(batch)
 
             # Choose initial random time point at the PDE solution manifold
-            start_time = random.choices([t for t in range(max_start_time + 1)], k=1)
+            start_time = int(rng.integers(0, max_start_time + 1))
             yield datautils.create_data2D(
                 self.n_input_scalar_components,
                 self.n_input_vector_components,
@@ -313,13 +370,87 @@ class RandomizedPDETrainData(dp.iter.IterDataPipe):
                 u,
                 v,
                 grid,
-                start_time[0],
+                start_time,
                 self.time_history,
                 self.time_future,
                 self.time_gap,
             )
 
 
+class CycledRandomizedPDETrainData(RandomizedPDETrainData):
+    """Randomized data for training PDEs drawing several samples from each loaded trajectory.
+
+    Every sample follows the same distribution as with `RandomizedPDETrainData(dp.cycle(n_cycles), ...)`, but every
+    trajectory is read only once instead of `n_cycles` times.
+
+    Args:
+        dp (IterDataPipe): Data pipe that returns individual PDE trajectories.
+        n_input_scalar_components (int): Number of input scalar components.
+        n_input_vector_components (int): Number of input vector components.
+        n_output_scalar_components (int): Number of output scalar components.
+        n_output_vector_components (int): Number of output vector components.
+        trajlen (int): Length of a trajectory in the dataset.
+        time_history (int): Number of time steps of inputs.
+        time_future (int): Number of time steps of outputs.
+        time_gap (int): Number of time steps between inputs and outputs.
+        n_cycles (int): Number of random samples drawn from each trajectory.
+
+    Note:
+        Unlike with `cycle`, the `n_cycles` consecutive samples all come from the same trajectory, so batches taken
+        straight from this datapipe are strongly correlated. Follow it with a shuffle buffer spanning several
+        trajectories, as [build_datapipes][pdearena.data.twod.datapipes.common.build_datapipes] does.
+    """
+
+    def __init__(
+        self,
+        dp,
+        n_input_scalar_components: int,
+        n_input_vector_components: int,
+        n_output_scalar_components: int,
+        n_output_vector_components: int,
+        trajlen: int,
+        time_history: int,
+        time_future: int,
+        time_gap: int,
+        n_cycles: int,
+    ) -> None:
+        super().__init__(
+            dp,
+            n_input_scalar_components,
+            n_input_vector_components,
+            n_output_scalar_components,
+            n_output_vector_components,
+            trajlen,
+            time_history,
+            time_future,
+            time_gap,
+        )
+        self.n_cycles = n_cycles
+
+    @torch.inference_mode()
+    def __iter__(self):
+        max_start_time, n_cycles = self._max_start_time, self.n_cycles
+        rng = _new_rng()
+        for batch in self.dp:
+            u, v, _, grid = _unpack_trajectory(batch)
+
+            # Choose all initial random time points for this trajectory at once
+            for start_time in rng.integers(0, max_start_time + 1, size=n_cycles).tolist():
+                yield datautils.create_data2D(
+                    self.n_input_scalar_components,
+                    self.n_input_vector_components,
+                    self.n_output_scalar_components,
+                    self.n_output_vector_components,
+                    u,
+                    v,
+                    grid,
+                    start_time,
+                    self.time_history,
+                    self.time_future,
+                    self.time_gap,
+                )
+
+
 class PDEEvalTimeStepData(dp.iter.IterDataPipe):
     def __init__(
         self,
@@ -344,49 +475,52 @@ class PDEEvalTimeStepData(dp.iter.IterDataPipe):
         self.time_future = time_future
         self.time_gap = time_gap
 
-    def __iter__(self):
-        # Length of trajectory
-        time_resolution = self.trajlen
         # Max number of previous points solver can eat
-        reduced_time_resolution = time_resolution - self.time_history
+        reduced_time_resolution = trajlen - time_history
         # Number of future points to predict
-        max_start_time = reduced_time_resolution - self.time_future - self.time_gap
+        max_start_time = reduced_time_resolution - time_future - time_gap
         # We ignore these timesteps in the testing
-        start_time = [t for t in range(max_start_time + 1, self.time_gap + self.time_future)]
-        for start in start_time:
-            for (u, v, cond, grid) in self.dp:
-
-                end_time = start + self.time_history
-                target_start_time = end_time + self.time_gap
-                target_end_time = target_start_time + self.time_future
-                data_scalar = torch.Tensor()
-                data_vector = torch.Tensor()
-                labels_scalar = torch.Tensor()
-                labels_vector = torch.Tensor()
-                if self.n_input_scalar_components > 0:
-                    data_scalar = u[
-                        start:end_time,
-                        ...,
-                    ]
-                if self.n_output_scalar_components > 0:
-                    labels_scalar = u[
-                        target_start_time:target_end_time,
-                        ...,
-                    ]
-                if self.n_input_vector_components > 0:
-                    data_vector = v[
-                        start:end_time,
-                        ...,
-                    ]
-                if self.n_output_vector_components > 0:
-                    labels_vector = v[
-                        target_start_time:target_end_time,
-                        ...,
-                    ]
-
-                # add batch dim
-                data = torch.cat((data_scalar, data_vector), dim=1).unsqueeze(0)
-
-                # add batch dim
-                labels = torch.cat((labels_scalar, labels_vector), dim=1).unsqueeze(0)
-                yield data, labels
+        start_times = range(0, max_start_time + 1, time_gap + time_future)
+        # Input and target time ranges of every evaluation window
+        target_offset = time_history + time_gap
+        self._windows = tuple(
+            (start, start + time_history, start + target_offset, start + target_offset + time_future)
+            for start in start_times
+        )
+
+        # Number of channels taken from the scalar and vector fields for inputs and labels
+        self._input_channels = (n_input_scalar_components, 2 * n_input_vector_components)
+        self._output_channels = (n_output_scalar_components, 2 * n_output_vector_components)
+
+    @staticmethod
+    def _window(u, v, start: int, end: int, channels: Tuple[int, int]) -> torch.Tensor:
+        # Write the fields of time steps `[start, end)` into their channel slices of one new tensor with a batch dim
+        n_scalar, n_vector = channels
+        ref = u if n_scalar > 0 else v
+        # Match the type promotion of `torch.cat`
+        dtype = torch.promote_types(u.dtype, v.dtype) if n_scalar > 0 and n_vector > 0 else ref.dtype
+        out = ref.new_empty((1, end - start, n_scalar + n_vector, *ref.shape[2:]), dtype=dtype)
+        if n_scalar > 0:
+            out[0, :, :n_scalar].copy_(u[start:end, :n_scalar])
+        if n_vector > 0:
+            out[0, :, n_scalar:].copy_(v[start:end, :n_vector])
+        return out
+
+    @torch.inference_mode()
+    def __iter__(self):
+        # Local bindings keep attribute lookups out of the loops
+        windows = self._windows
+        input_channels, output_channels = self._input_channels, self._output_channels
+        window = self._window
+        # Each trajectory is read once and all its evaluation windows are emitted before moving on to the next one
+        for (u, v, cond, grid) in self.dp:
+            if input_channels == output_channels:
+                # Inputs and labels share a layout, so every window is a view of one merged trajectory tensor
+                uv = _merge_fields(u, v, input_channels)
+                for (start, end_time, target_start_time, target_end_time) in windows:
+                    yield uv[start:end_time].unsqueeze(0), uv[target_start_time:target_end_time].unsqueeze(0)
+            else:
+                for (start, end_time, target_start_time, target_end_time) in windows:
+                    data = window(u, v, start, end_time, input_channels)
+                    labels = window(u, v, target_start_time, target_end_time, output_channels)
+                    yield data, labels
@@ -43,9 +43,9 @@ class NavierStokesDatasetOpener(dp.iter.IterDataPipe):
                 iter_end = num
 
                 for idx in range(iter_start, iter_end):
-                    u = torch.tensor(data["u"][idx])
-                    vx = torch.tensor(data["vx"][idx])
-                    vy = torch.tensor(data["vy"][idx])
+                    u = torch.from_numpy(data["u"][idx])
+                    vx = torch.from_numpy(data["vx"][idx])
+                    vy = torch.from_numpy(data["vy"][idx])
                     if "buo_y" in data:
                         cond = torch.tensor(data["buo_y"][idx]).unsqueeze(0).float()
                     else:
@@ -88,14 +88,14 @@ class ShallowWaterDatasetOpener(dp.iter.IterDataPipe):
 
             for idx in range(iter_start, iter_end):
                 if self.usevort:
-                    vort = torch.tensor(data["vor"][idx].to_numpy())
+                    vort = torch.from_numpy(data["vor"][idx].to_numpy())
                     vort = (vort - normstat["vor"]["mean"]) / normstat["vor"]["std"]
                 else:
-                    u = torch.tensor(data["u"][idx].to_numpy())
-                    v = torch.tensor(data["v"][idx].to_numpy())
+                    u = torch.from_numpy(data["u"][idx].to_numpy())
+                    v = torch.from_numpy(data["v"][idx].to_numpy())
                     vecf = torch.cat((u, v), dim=1)
 
-                pres = torch.tensor(data["pres"][idx].to_numpy())
+                pres = torch.from_numpy(data["pres"][idx].to_numpy())
 
                 pres = (pres - normstat["pres"]["mean"]) / normstat["pres"]["std"]
                 pres = pres.unsqueeze(1)
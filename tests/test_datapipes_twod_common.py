@@ -1,13 +1,291 @@
-from pdearena.data.twod.datapipes.common import ZarrLister
+import os
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torchdata.datapipes as dp
+
+from pdearena.data.twod.datapipes.common import (
+    CycledRandomizedPDETrainData,
+    PDEEvalTimeStepData,
+    RandomTimeStepConditionedPDETrainData,
+    TimestepConditionedPDEEvalData,
+    ZarrLister,
+    build_datapipes,
+)
+from pdearena.data.utils import PDEDataConfig, create_data2D
+
+
+def _mock_scandir(mocker, names):
+    scandir = mocker.patch("os.scandir")
+    scandir.return_value.__enter__.return_value = [
+        SimpleNamespace(name=name, path=os.path.join("/tmp", name)) for name in names
+    ]
+    return scandir
 
 
 class TestZarrLister:
     def test_zarr_mix(self, mocker):
-        mocker.patch("os.listdir", return_value=["a.zarr", "b.zarr", "c.zarr", "a", "b", "c"])
+        _mock_scandir(mocker, ["c.zarr", "a.zarr", "b.zarr", "a", "b", "c"])
         dp = ZarrLister("/tmp")
         assert list(dp) == ["/tmp/a.zarr", "/tmp/b.zarr", "/tmp/c.zarr"]
 
     def test_nozarr(self, mocker):
-        mocker.patch("os.listdir", return_value=["a", "b", "c"])
+        _mock_scandir(mocker, ["a", "b", "c"])
         dp = ZarrLister("/tmp")
         assert list(dp) == []
+
+    def test_cached_listing(self, mocker):
+        scandir = _mock_scandir(mocker, ["a.zarr", "b"])
+        dp = ZarrLister("/tmp")
+        assert list(dp) == ["/tmp/a.zarr"]
+        assert list(dp) == ["/tmp/a.zarr"]
+        scandir.assert_called_once_with("/tmp")
+
+
+def _time_indexed_trajectory(trajlen, n_scalar_channels=1, n_vector_channels=2, n=2):
+    # Every entry holds its time index, so sampled windows can be traced back to their time steps
+    t = torch.arange(trajlen, dtype=torch.float32).view(trajlen, 1, 1, 1)
+    return t.expand(trajlen, n_scalar_channels, n, n).clone(), t.expand(trajlen, n_vector_channels, n, n).clone()
+
+
+class TestRandomTimeStepConditionedPDETrainData:
+    @pytest.mark.parametrize("reweigh", [True, False])
+    def test_time_steps(self, reweigh):
+        trajlen = 5
+        n_samples = 20000
+        torch.manual_seed(0)
+        u, v = _time_indexed_trajectory(trajlen)
+        source = dp.iter.IterableWrapper([(u, v, None, None)] * n_samples, deepcopy=False)
+        pipe = RandomTimeStepConditionedPDETrainData(source, 1, 1, 1, 1, trajlen, reweigh)
+
+        counts = Counter()
+        for data, targets, delta_t, cond in pipe:
+            start_time = int(data[0, 0, 0, 0, 0])
+            end_time = int(targets[0, 0, 0, 0, 0])
+            assert 0 <= start_time < end_time < trajlen
+            assert delta_t.tolist() == [end_time - start_time]
+            assert cond is None
+            counts[(start_time, end_time)] += 1
+        assert sum(counts.values()) == n_samples
+
+        for end_time in range(1, trajlen):
+            if reweigh:
+                weights = [1 / (start_time + 1) for start_time in range(end_time)]
+            else:
+                weights = [1.0] * end_time
+            for start_time in range(end_time):
+                expected = weights[start_time] / sum(weights) / (trajlen - 1)
+                assert counts[(start_time, end_time)] / n_samples == pytest.approx(expected, abs=0.015)
+
+
+def _offset_trajectories(trajlen, n_trajectories):
+    # Trajectory k holds 100 * k + t at time step t, so samples can be traced back to their trajectory and time steps
+    trajectories = []
+    for k in range(n_trajectories):
+        u, v = _time_indexed_trajectory(trajlen)
+        trajectories.append((u + 100 * k, v + 100 * k, None))
+    return trajectories
+
+
+def _check_training_sample(trajectories, data, targets, time_history, time_future, time_gap):
+    k = int(data[0, 0, 0, 0, 0]) // 100
+    u, v, _ = trajectories[k]
+    start = int(data[0, 0, 0, 0, 0]) - 100 * k
+    expected_data, expected_targets = create_data2D(1, 1, 1, 1, u, v, None, start, time_history, time_future, time_gap)
+    torch.testing.assert_close(data, expected_data)
+    torch.testing.assert_close(targets, expected_targets)
+    return k, start
+
+
+class TestCycledRandomizedPDETrainData:
+    def test_samples(self):
+        trajlen, n_cycles, n_trajectories = 10, 50, 3
+        time_history, time_future, time_gap = 2, 1, 1
+        torch.manual_seed(0)
+        trajectories = _offset_trajectories(trajlen, n_trajectories)
+        pipe = CycledRandomizedPDETrainData(
+            dp.iter.IterableWrapper(trajectories, deepcopy=False),
+            1,
+            1,
+            1,
+            1,
+            trajlen,
+            time_history,
+            time_future,
+            time_gap,
+            n_cycles=n_cycles,
+        )
+
+        samples = list(pipe)
+        assert len(samples) == n_trajectories * n_cycles
+        starts = set()
+        for i, (data, targets) in enumerate(samples):
+            k, start = _check_training_sample(trajectories, data, targets, time_history, time_future, time_gap)
+            # Without a shuffle, the samples of a trajectory come out back to back
+            assert k == i // n_cycles
+            starts.add(start)
+        assert starts == set(range(trajlen - time_history - time_future - time_gap + 1))
+
+
+class TestBuildTrainDatapipes:
+    @pytest.mark.parametrize("shuffle_buffer_size", [None, 7])
+    def test_unconditioned(self, shuffle_buffer_size):
+        trajlen, n_cycles, n_trajectories = 10, 5, 6
+        time_history, time_future, time_gap = 2, 1, 0
+        torch.manual_seed(0)
+        trajectories = _offset_trajectories(trajlen, n_trajectories)
+        files = {f"{k}.h5": trajectory for k, trajectory in enumerate(trajectories)}
+        pipe = build_datapipes(
+            PDEDataConfig(n_scalar_components=1, n_vector_components=1, trajlen=trajlen, n_spatial_dims=2),
+            "data",
+            None,
+            False,
+            dataset_opener=lambda paths, mode, limit_trajectories, usegrid: paths.map(files.__getitem__),
+            lister=lambda path: dp.iter.IterableWrapper(list(files)),
+            sharder=lambda pipe: pipe,
+            filter_fn=bool,
+            mode="train",
+            time_history=time_history,
+            time_future=time_future,
+            time_gap=time_gap,
+            prefetch_buffer_size=0,
+            samples_per_trajectory=n_cycles,
+            shuffle_buffer_size=shuffle_buffer_size,
+        )
+        assert isinstance(pipe, dp.iter.Shuffler)
+        assert isinstance(pipe.datapipe, CycledRandomizedPDETrainData)
+        assert pipe.buffer_size == (8 * n_cycles if shuffle_buffer_size is None else shuffle_buffer_size)
+
+        samples = list(pipe)
+        assert len(samples) == n_trajectories * n_cycles
+        trajectory_ids = [
+            _check_training_sample(trajectories, data, targets, time_history, time_future, time_gap)[0]
+            for data, targets in samples
+        ]
+        assert Counter(trajectory_ids) == {k: n_cycles for k in range(n_trajectories)}
+        # Samples of different trajectories are interleaved instead of coming out back to back
+        n_switches = sum(a != b for a, b in zip(trajectory_ids, trajectory_ids[1:]))
+        assert n_switches > n_trajectories - 1
+
+
+def _reference_window(u, v, start, end, n_scalar_components, n_vector_components):
+    fields = []
+    if n_scalar_components > 0:
+        fields.append(u[start:end, :n_scalar_components])
+    if n_vector_components > 0:
+        fields.append(v[start:end, : 2 * n_vector_components])
+    return torch.cat(fields, dim=1).unsqueeze(0)
+
+
+class TestPDEEvalTimeStepData:
+    @pytest.mark.parametrize("n_scalar_components,n_vector_components", [(1, 1), (2, 0), (0, 1)])
+    @pytest.mark.parametrize("time_history,time_future,time_gap", [(1, 1, 0), (4, 1, 0), (2, 3, 1)])
+    def test_windows(self, n_scalar_components, n_vector_components, time_history, time_future, time_gap):
+        trajlen = 14
+        N = 8
+        # Fields carry an extra channel that must not end up in the windows
+        trajectories = [
+            (
+                torch.rand(trajlen, n_scalar_components + 1, N, N),
+                torch.rand(trajlen, 2 * n_vector_components + 1, N, N) if n_vector_components > 0 else None,
+                None,
+                None,
+            )
+            for _ in range(3)
+        ]
+        pipe = PDEEvalTimeStepData(
+            dp.iter.IterableWrapper(trajectories, deepcopy=False),
+            n_scalar_components,
+            n_vector_components,
+            n_scalar_components,
+            n_vector_components,
+            trajlen,
+            time_history,
+            time_future,
+            time_gap,
+        )
+
+        expected = []
+        max_start_time = trajlen - time_history - time_future - time_gap
+        for (u, v, _, _) in trajectories:
+            for start in range(0, max_start_time + 1, time_gap + time_future):
+                end_time = start + time_history
+                target_start_time = end_time + time_gap
+                expected.append(
+                    (
+                        _reference_window(u, v, start, end_time, n_scalar_components, n_vector_components),
+                        _reference_window(
+                            u,
+                            v,
+                            target_start_time,
+                            target_start_time + time_future,
+                            n_scalar_components,
+                            n_vector_components,
+                        ),
+                    )
+                )
+
+        samples = list(pipe)
+        assert len(samples) > 0
+        assert len(samples) == len(expected)
+        for (data, labels), (expected_data, expected_labels) in zip(samples, expected):
+            torch.testing.assert_close(data, expected_data)
+            torch.testing.assert_close(labels, expected_labels)
+
+    @pytest.mark.parametrize("n_input_vector_components,n_output_vector_components", [(1, 1), (1, 0), (0, 1)])
+    def test_mixed_dtypes(self, n_input_vector_components, n_output_vector_components):
+        trajlen = 6
+        N = 4
+        u = torch.rand(trajlen, 1, N, N, dtype=torch.float32)
+        v = torch.rand(trajlen, 2, N, N, dtype=torch.float64)
+        pipe = PDEEvalTimeStepData(
+            dp.iter.IterableWrapper([(u, v, None, None)], deepcopy=False),
+            1,
+            n_input_vector_components,
+            1,
+            n_output_vector_components,
+            trajlen,
+            1,
+            1,
+            0,
+        )
+
+        samples = list(pipe)
+        assert len(samples) == trajlen - 1
+        for start, (data, labels) in enumerate(samples):
+            # Windows get the dtype `torch.cat` promotes the fields to
+            torch.testing.assert_close(data, _reference_window(u, v, start, start + 1, 1, n_input_vector_components))
+            torch.testing.assert_close(
+                labels, _reference_window(u, v, start + 1, start + 2, 1, n_output_vector_components)
+            )
+
+
+class TestTimestepConditionedPDEEvalData:
+    @pytest.mark.parametrize("delta_t", [1, 2, 3])
+    def test_windows(self, delta_t):
+        trajlen = 8
+        N = 8
+        trajectories = [
+            (torch.rand(trajlen, 1, N, N), torch.rand(trajlen, 2, N, N), torch.rand(1, 1), None) for _ in range(2)
+        ]
+        pipe = TimestepConditionedPDEEvalData(dp.iter.IterableWrapper(trajectories, deepcopy=False), trajlen, delta_t)
+
+        expected = []
+        for (u, v, cond, _) in trajectories:
+            for begin in range(trajlen - delta_t):
+                newu = u[begin::delta_t]
+                newv = v[begin::delta_t]
+                for start in range(newu.size(0) - 1):
+                    data = torch.cat((newu[start : start + 1], newv[start : start + 1]), dim=1).unsqueeze(0)
+                    label = torch.cat((newu[start + 1 : start + 2], newv[start + 1 : start + 2]), dim=1).unsqueeze(0)
+                    expected.append((data, label, cond))
+
+        samples = list(pipe)
+        assert len(samples) == len(expected)
+        for (data, label, dt, cond), (expected_data, expected_label, expected_cond) in zip(samples, expected):
+            torch.testing.assert_close(data, expected_data)
+            torch.testing.assert_close(label, expected_label)
+            assert dt.tolist() == [delta_t]
+            assert cond is expected_cond